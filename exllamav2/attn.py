@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from exllamav2.module import ExLlamaV2Module
+from exllamav2.module import ExLlamaV2Module, _scratch_align
 from exllamav2.rmsnorm import ExLlamaV2RMSNorm
 from exllamav2.linear import ExLlamaV2Linear
 from exllamav2.cache import ExLlamaV2Cache
@@ -38,6 +38,8 @@ class ExLlamaV2Attention(ExLlamaV2Module):
         super().__init__(model, key)
 
         self.layer_idx = layer_idx
+        self.temp_state = None
+        self.temp_dq = None
 
         hidden_size = self.model.config.hidden_size
 
@@ -102,6 +104,9 @@ class ExLlamaV2Attention(ExLlamaV2Module):
         self.v_proj.unload()
         self.o_proj.unload()
 
+        self.temp_state = None
+        self.temp_dq = None
+
 
     def weight_footprint(self):
 
@@ -112,6 +117,12 @@ class ExLlamaV2Attention(ExLlamaV2Module):
                self.o_proj.weight_footprint()
 
 
+    def holds_scratch(self):
+
+        return self.temp_state is not None or \
+               self.temp_dq is not None
+
+
     def scratch_space_fixed(self):
 
         return self.temp_state_size() + \
@@ -131,22 +142,22 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
     def temp_state_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.hidden_size * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.hidden_size * 2)
 
 
     def temp_q_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_attention_heads * self.model.config.head_dim * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_attention_heads * self.model.config.head_dim * 2)
 
 
     def temp_k_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_key_value_heads * self.model.config.head_dim * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_key_value_heads * self.model.config.head_dim * 2)
 
 
     def temp_v_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_key_value_heads * self.model.config.head_dim * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.num_key_value_heads * self.model.config.head_dim * 2)
 
 
     def temp_dq_size(self):
@@ -160,13 +171,23 @@ class ExLlamaV2Attention(ExLlamaV2Module):
     def temp_kv_size(self):
 
         if self.model.config.num_key_value_heads == self.model.config.num_attention_heads: return 0
-        return 2 * self.model.config.max_seq_len * self.model.config.max_batch_size * self.model.config.num_attention_heads * self.model.config.head_dim * 2 + 128
+        return _scratch_align(2 * self.model.config.max_seq_len * self.model.config.max_batch_size * self.model.config.num_attention_heads * self.model.config.head_dim * 2)
 
 
     def temp_attn_size(self):
 
         att_max = min(self.model.config.max_attention_size, self.model.config.max_seq_len ** 2)
-        return 2 * att_max * self.model.config.num_attention_heads * 2 + 128
+        return _scratch_align(2 * att_max * self.model.config.num_attention_heads * 2)
+
+
+    def cache_footprint(self):
+
+        # Keys and values for this layer in an ExLlamaV2Cache of max_batch_size * max_seq_len. An 8-bit cache stores one
+        # byte per element plus a float16 scale per head and position
+
+        head_dim = self.model.config.head_dim
+        head_bytes = head_dim * 2 if self.model.config.kv_dtype == torch.float16 else head_dim + 2
+        return 2 * self.model.config.max_batch_size * self.model.config.max_seq_len * self.model.config.num_key_value_heads * head_bytes
 
 
     def set_device_idx(self, idx):
@@ -196,7 +217,7 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
         batch_size = hidden_states.shape[0]
         q_len = hidden_states.shape[1]
-        direct = (batch_size == 1 and cache is not None and isinstance(cache, ExLlamaV2Cache))
+        direct = (batch_size == 1 and cache is not None and isinstance(cache, ExLlamaV2Cache) and cache.kv_dtype == torch.float16)
 
         # past_len = 0
         # if cache is not None:
@@ -265,18 +286,11 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
                 else:
 
-                    batch_keys = cache.key_states[self.layer_idx].narrow(0, 0, batch_size)
-                    batch_values = cache.value_states[self.layer_idx].narrow(0, 0, batch_size)
-
-                    new_keys = batch_keys.narrow(1, past_len, q_len)
-                    new_values = batch_values.narrow(1, past_len, q_len)
-                    new_keys.copy_(k_states)
-                    new_values.copy_(v_states)
+                    cache.store_kv(self.layer_idx, batch_size, past_len, k_states, v_states)
 
                     # Key/value tensors with past
 
-                    k_states = batch_keys.narrow(1, 0, past_len + q_len)
-                    v_states = batch_values.narrow(1, 0, past_len + q_len)
+                    k_states, v_states = cache.get_kv(self.layer_idx, batch_size, past_len + q_len)
 
             # Torch matmul attention
 
@@ -336,18 +350,11 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
                 # Add keys and values to cache
 
-                batch_keys = cache[i].key_states[self.layer_idx]
-                batch_values = cache[i].value_states[self.layer_idx]
-
-                new_keys = batch_keys.narrow(1, past_len[1][i], q_len)
-                new_values = batch_values.narrow(1, past_len[1][i], q_len)
-                new_keys.copy_(k_states.narrow(0, i, 1))
-                new_values.copy_(v_states.narrow(0, i, 1))
+                cache[i].store_kv(self.layer_idx, 1, past_len[1][i], k_states.narrow(0, i, 1), v_states.narrow(0, i, 1))
 
                 # Key/value tensors with past
 
-                k_states_b = batch_keys.narrow(1, 0, past_len[1][i] + q_len)
-                v_states_b = batch_values.narrow(1, 0, past_len[1][i] + q_len)
+                k_states_b, v_states_b = cache[i].get_kv(self.layer_idx, 1, past_len[1][i] + q_len)
 
                 # Torch matmul attention
 
@@ -441,15 +448,11 @@ class ExLlamaV2Attention(ExLlamaV2Module):
 
         if cache is not None:
 
-            new_keys = cache.key_states[self.layer_idx].narrow(1, past_len, q_len).narrow(0, 0, batch_size)
-            new_values = cache.value_states[self.layer_idx].narrow(1, past_len, q_len).narrow(0, 0, batch_size)
-            new_keys.copy_(key_states)
-            new_values.copy_(value_states)
+            cache.store_kv(self.layer_idx, batch_size, past_len, key_states, value_states)
 
             # Key/value tensors with past
 
-            key_states = cache.key_states[self.layer_idx].narrow(1, 0, past_len + q_len)
-            value_states = cache.value_states[self.layer_idx].narrow(1, 0, past_len + q_len)
+            key_states, value_states = cache.get_kv(self.layer_idx, batch_size, past_len + q_len)
 
         # Attention
 
@@ -2,14 +2,23 @@ import torch
 
 class ExLlamaV2Cache:
 
-    def __init__(self, model, batch_size = 1, max_seq_len = -1, copy_from = None):
+    def __init__(self, model, batch_size = 1, max_seq_len = -1, copy_from = None, kv_dtype = None):
 
         self.model = model
         self.max_seq_len = max_seq_len if max_seq_len != -1 else self.model.config.max_seq_len
         self.batch_size = batch_size
 
+        # 16-bit cache, or 8-bit cache with one scale per head and position
+
+        if kv_dtype is None: kv_dtype = copy_from.kv_dtype if copy_from is not None else self.model.config.kv_dtype
+        assert kv_dtype in (torch.float16, torch.int8), "Unsupported cache datatype"
+        assert copy_from is None or kv_dtype == copy_from.kv_dtype, "Can't copy cache to a different datatype"
+        self.kv_dtype = kv_dtype
+
         self.key_states = []
         self.value_states = []
+        self.key_scales = []
+        self.value_scales = []
         self.current_seq_len = 0
 
         # Preallocate full-length cache
@@ -22,14 +31,22 @@ class ExLlamaV2Cache:
 
             if copy_from is None:
 
-                p_key_states = torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, head_dim, dtype = torch.float16, device = self.model.cache_map[i])
-                p_value_states = torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, head_dim, dtype = torch.float16, device = self.model.cache_map[i])
+                p_key_states = torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, head_dim, dtype = self.kv_dtype, device = self.model.cache_map[i])
+                p_value_states = torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, head_dim, dtype = self.kv_dtype, device = self.model.cache_map[i])
+
+                if self.kv_dtype == torch.int8:
+                    self.key_scales.append(torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, 1, dtype = torch.float16, device = self.model.cache_map[i]))
+                    self.value_scales.append(torch.zeros(self.batch_size, self.max_seq_len, num_key_value_heads, 1, dtype = torch.float16, device = self.model.cache_map[i]))
 
             else:
 
                 p_key_states = copy_from.key_states[i].clone()
                 p_value_states = copy_from.value_states[i].clone()
 
+                if self.kv_dtype == torch.int8:
+                    self.key_scales.append(copy_from.key_scales[i].clone())
+                    self.value_scales.append(copy_from.value_scales[i].clone())
+
             self.key_states.append(p_key_states)
             self.value_states.append(p_value_states)
 
@@ -37,10 +54,10 @@ class ExLlamaV2Cache:
     def footprint(self):
 
         fp = []
-        for layer in self.key_states + self.value_states:
+        for layer in self.key_states + self.value_states + self.key_scales + self.value_scales:
             dev = layer.device.index
             while len(fp) <= dev: fp.append(0)
-            fp[dev] += layer.numel() * 2
+            fp[dev] += layer.numel() * layer.element_size()
 
         return fp
 
@@ -58,6 +75,10 @@ class ExLlamaV2Cache:
             self.key_states[i] = torch.roll(self.key_states[i], shifts = -1, dims = 2)
             self.value_states[i] = torch.roll(self.value_states[i], shifts = -1, dims = 2)
 
+            if self.kv_dtype == torch.int8:
+                self.key_scales[i] = torch.roll(self.key_scales[i], shifts = -1, dims = 2)
+                self.value_scales[i] = torch.roll(self.value_scales[i], shifts = -1, dims = 2)
+
         self.current_seq_len -= 1
 
 
@@ -67,21 +88,68 @@ class ExLlamaV2Cache:
         assert from_columns == to_columns
         assert to_column + to_columns <= target.max_seq_len
         assert from_column + from_columns <= self.max_seq_len
+        assert target.kv_dtype == self.kv_dtype
 
         num_hidden_layers = self.model.config.num_hidden_layers
 
+        source = [self.key_states, self.value_states, self.key_scales, self.value_scales]
+        dest = [target.key_states, target.value_states, target.key_scales, target.value_scales]
+
         for i in range(num_hidden_layers):
+            for source_layers, target_layers in zip(source, dest):
+
+                if not source_layers: continue
+
+                source_view = source_layers[i].narrow(0, from_row, from_rows).narrow(2, from_column, from_columns)
+                target_view = target_layers[i].narrow(0, to_row, to_rows).narrow(2, to_column, to_columns)
+
+                if to_rows > 1: source_view = source_view.expand_as(target_view)
+
+                target_view.copy_(source_view)
+
+
+    def store_kv(self, layer_idx, batch_size, offset, keys, values):
+
+        # Write keys and values of shape (batch_size, q_len, num_key_value_heads, head_dim) at position offset
+
+        q_len = keys.shape[1]
+        new_keys = self.key_states[layer_idx].narrow(0, 0, batch_size).narrow(1, offset, q_len)
+        new_values = self.value_states[layer_idx].narrow(0, 0, batch_size).narrow(1, offset, q_len)
+
+        if self.kv_dtype == torch.float16:
+            new_keys.copy_(keys)
+            new_values.copy_(values)
+            return
+
+        new_key_scales = self.key_scales[layer_idx].narrow(0, 0, batch_size).narrow(1, offset, q_len)
+        new_value_scales = self.value_scales[layer_idx].narrow(0, 0, batch_size).narrow(1, offset, q_len)
+        _quant_int8(keys, new_keys, new_key_scales)
+        _quant_int8(values, new_values, new_value_scales)
+
+
+    def get_kv(self, layer_idx, batch_size, length):
+
+        # Keys and values for the first length positions, as float16
+
+        keys = self.key_states[layer_idx].narrow(0, 0, batch_size).narrow(1, 0, length)
+        values = self.value_states[layer_idx].narrow(0, 0, batch_size).narrow(1, 0, length)
+
+        if self.kv_dtype == torch.float16: return keys, values
+
+        key_scales = self.key_scales[layer_idx].narrow(0, 0, batch_size).narrow(1, 0, length)
+        value_scales = self.value_scales[layer_idx].narrow(0, 0, batch_size).narrow(1, 0, length)
+        return _dequant_int8(keys, key_scales), _dequant_int8(values, value_scales)
+
+
+def _quant_int8(x, q, scale):
 
-            source_view_k = self.key_states[i].narrow(0, from_row, from_rows).narrow(2, from_column, from_columns)
-            source_view_v = self.value_states[i].narrow(0, from_row, from_rows).narrow(2, from_column, from_columns)
-            target_view_k = target.key_states[i].narrow(0, to_row, to_rows).narrow(2, to_column, to_columns)
-            target_view_v = target.value_states[i].narrow(0, to_row, to_rows).narrow(2, to_column, to_columns)
+    # Symmetric absmax quantization, one scale per head
 
-            if to_rows > 1:
+    scale.copy_(x.abs().amax(dim = -1, keepdim = True) / 127)
+    scale.clamp_(min = 1e-4)
+    q.copy_(torch.round(x.float() / scale.float()))
 
-                source_view_k = source_view_k.expand_as(target_view_k)
-                source_view_v = source_view_v.expand_as(target_view_v)
 
-            target_view_k.copy_(source_view_k)
-            target_view_v.copy_(source_view_v)
+def _dequant_int8(q, scale):
 
+    return q.half() * scale
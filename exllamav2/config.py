@@ -14,6 +14,7 @@ class ExLlamaV2Config:
 
     scale_pos_emb: float = 1.0                  # Factor by which to scale positional embeddings, e.g. for 4096-token sequence use a scaling factor of 2.0, requires finetuned model or LoRA
     scale_alpha_value: float = 1.0              # Alpha value for NTK RoPE scaling. Similar to compress_pos_emb but works without finetuned model
+    kv_dtype: torch.dtype = torch.float16       # Default datatype for ExLlamaV2Cache keys/values. torch.int8 halves cache size, with one scale per head and position
 
     # Loaded/set by .prepare():
 
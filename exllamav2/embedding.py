@@ -63,7 +63,18 @@ class ExLlamaV2Embedding(ExLlamaV2Module):
 
     def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, intermediates = False):
 
-        hidden_states = self.embedding.forward(hidden_states)
+        # When embedding on the CPU, gather into pinned memory so the copy to the first GPU can be issued asynchronously
+
+        if self.device_idx == -1 and torch.cuda.is_available():
+
+            ids = hidden_states.reshape(-1)
+            output = torch.empty((ids.shape[0], self.model.config.hidden_size), dtype = torch.half, pin_memory = True)
+            torch.index_select(self.embedding.weight.data, 0, ids, out = output)
+            hidden_states = output.view(hidden_states.shape + (self.model.config.hidden_size,))
+
+        else:
+
+            hidden_states = self.embedding.forward(hidden_states)
 
         if intermediates:
             return {"hidden_states": hidden_states}
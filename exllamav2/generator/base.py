@@ -52,6 +52,8 @@ class ExLlamaV2BaseGenerator:
         overflow = ids.shape[-1] + num_tokens - self.model.config.max_seq_len
         if overflow > 0: ids = ids[:, -overflow:]
 
+        if mask is not None: mask = self.model.prepare_input_mask(mask)
+
         self._gen_begin_base(ids, mask)
 
         for i in range(num_tokens):
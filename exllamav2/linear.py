@@ -1,5 +1,5 @@
 import torch
-from exllamav2.module import ExLlamaV2Module
+from exllamav2.module import ExLlamaV2Module, _scratch_align
 from torch import nn
 from exllamav2 import ext
 from exllamav2.ext import exllamav2_ext as ext_c, none_tensor
@@ -52,6 +52,7 @@ class ExLlamaV2Linear(ExLlamaV2Module):
 
         del self.linear
         self.linear = None
+        self.temp_dq = None
 
 
     def get_weight(self):
@@ -59,6 +60,11 @@ class ExLlamaV2Linear(ExLlamaV2Module):
         return self.linear.weight.data
 
 
+    def holds_scratch(self):
+
+        return self.temp_dq is not None
+
+
     def scratch_space_fixed(self):
 
         return self.temp_dq_size() + \
@@ -73,12 +79,12 @@ class ExLlamaV2Linear(ExLlamaV2Module):
 
     def temp_dq_size(self):
 
-        return self.in_features * self.out_features * 2 + 128
+        return _scratch_align(self.in_features * self.out_features * 2)
 
 
     def temp_fwd_size(self):
 
-        return self.out_features * self.model.config.max_input_len * self.model.config.max_batch_size * 4 + 128
+        return _scratch_align(self.out_features * self.model.config.max_input_len * self.model.config.max_batch_size * 4)
 
 
     def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, intermediates = False, force_recons = False, force_cuda = False):
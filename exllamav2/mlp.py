@@ -1,6 +1,6 @@
 import torch
 import torch.nn.functional as F
-from exllamav2.module import ExLlamaV2Module
+from exllamav2.module import ExLlamaV2Module, _scratch_align
 from exllamav2.rmsnorm import ExLlamaV2RMSNorm
 from exllamav2.linear import ExLlamaV2Linear
 from exllamav2.ext import exllamav2_ext as ext_c, none_tensor
@@ -18,10 +18,19 @@ class ExLlamaV2MLP(ExLlamaV2Module):
 
     q_handle: int or None = None
 
+    temp_state: torch.tensor
+    temp_a: torch.tensor
+    temp_b: torch.tensor
+    temp_dq: torch.tensor
+
     def __init__(self, model, key, layer_idx):
         super().__init__(model, key)
 
         self.layer_idx = layer_idx
+        self.temp_state = None
+        self.temp_a = None
+        self.temp_b = None
+        self.temp_dq = None
 
         hidden_size = self.model.config.hidden_size
         intermediate_size = self.model.config.intermediate_size
@@ -48,15 +57,19 @@ class ExLlamaV2MLP(ExLlamaV2Module):
             assert self.up_proj.is_quant() and self.down_proj.is_quant(), "Partially quantized MLP layer"
             device_tensors = self.model.get_device_tensors(self.device_idx)
             device_tensors.begin_scratch_alloc()
+            self.temp_state = device_tensors.get_scratch_slice(self.temp_state_size())
+            self.temp_a = device_tensors.get_scratch_slice(self.temp_a_size())
+            self.temp_b = device_tensors.get_scratch_slice(self.temp_b_size())
+            self.temp_dq = device_tensors.get_scratch_slice(self.temp_dq_size())
             self.q_handle = ext_c.make_q_mlp(self.post_attention_layernorm.weight,
                                              self.post_attention_layernorm.variance_epsilon,
                                              self.gate_proj.q_handle,
                                              self.up_proj.q_handle,
                                              self.down_proj.q_handle,
-                                             device_tensors.get_scratch_slice(self.temp_state_size()),
-                                             device_tensors.get_scratch_slice(self.temp_a_size()),
-                                             device_tensors.get_scratch_slice(self.temp_b_size()),
-                                             device_tensors.get_scratch_slice(self.temp_dq_size()),
+                                             self.temp_state,
+                                             self.temp_a,
+                                             self.temp_b,
+                                             self.temp_dq,
                                              self.model.config.max_input_len * self.model.config.max_batch_size)
 
 
@@ -67,6 +80,11 @@ class ExLlamaV2MLP(ExLlamaV2Module):
         self.up_proj.unload()
         self.down_proj.unload()
 
+        self.temp_state = None
+        self.temp_a = None
+        self.temp_b = None
+        self.temp_dq = None
+
 
     def weight_footprint(self):
 
@@ -76,6 +94,14 @@ class ExLlamaV2MLP(ExLlamaV2Module):
                self.down_proj.weight_footprint()
 
 
+    def holds_scratch(self):
+
+        return self.temp_state is not None or \
+               self.temp_a is not None or \
+               self.temp_b is not None or \
+               self.temp_dq is not None
+
+
     def scratch_space_fixed(self):
 
         return self.temp_state_size() + \
@@ -95,17 +121,17 @@ class ExLlamaV2MLP(ExLlamaV2Module):
 
     def temp_state_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.hidden_size * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.hidden_size * 2)
 
 
     def temp_a_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.intermediate_size * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.intermediate_size * 2)
 
 
     def temp_b_size(self):
 
-        return self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.intermediate_size * 2 + 128
+        return _scratch_align(self.model.config.max_input_len * self.model.config.max_batch_size * self.model.config.intermediate_size * 2)
 
 
     def temp_dq_size(self):
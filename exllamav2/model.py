@@ -7,10 +7,12 @@ if sys.version_info < min_version:
 
 import torch
 import math
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from exllamav2.config import ExLlamaV2Config
 from exllamav2.cache import ExLlamaV2Cache
 from exllamav2.linear import ExLlamaV2Linear
-from exllamav2.module import ExLlamaV2Module
+from exllamav2.module import ExLlamaV2Module, SCRATCH_ALIGN
 from exllamav2.rmsnorm import ExLlamaV2RMSNorm
 from exllamav2.attn import ExLlamaV2Attention
 from exllamav2.mlp import ExLlamaV2MLP
@@ -22,6 +24,39 @@ def _torch_device(idx):
     return f"cuda:{idx}"
 
 
+# Most negative float16 value, used to mask attention weights
+
+_NEG_INF_H = torch.finfo(torch.float16).min
+
+
+# RoPE tables only depend on a few config values, so compute them once per process and copy them to each device
+# from a pinned host copy
+
+_sincos_cache = {}
+
+def _rope_base(base, alpha, head_dim):
+    if alpha != 1.0: base *= alpha ** (head_dim / (head_dim - 2))
+    return base
+
+
+def _input_mask_part(input_mask, width, device):
+
+    # Leading width columns of either a [batch_size, seq_len] mask or one from ExLlamaV2.prepare_input_mask()
+
+    if input_mask.dim() == 4: return input_mask[..., :width].to(device)
+    return input_mask[:, :width].to(device).unsqueeze(1).unsqueeze(2)
+
+
+def _move_attn_mask(attn_mask, device):
+
+    # Copy a mask built on another device. Masks expanded over the batch are copied once and expanded again
+
+    if attn_mask is None: return None
+    if isinstance(attn_mask, list): return [_move_attn_mask(m, device) for m in attn_mask]
+    if attn_mask.stride(0) == 0: return attn_mask[:1].to(device, non_blocking = True).expand_as(attn_mask)
+    return attn_mask.to(device, non_blocking = True)
+
+
 class ExLlamaV2DeviceTensors:
 
     model = None
@@ -33,6 +68,8 @@ class ExLlamaV2DeviceTensors:
 
     sin: torch.tensor
     cos: torch.tensor
+    causal_mask: torch.tensor
+    causal_mask_bool: torch.tensor
 
     scratch: torch.tensor = None
 
@@ -49,26 +86,61 @@ class ExLlamaV2DeviceTensors:
     def prepare(self, scratch):
 
         self.prepare_sincos()
+        self.prepare_causal_mask()
 
         if scratch:
-            self.scratch = torch.empty((self.scratch_bytes // 2,), dtype = torch.half, device = _torch_device(self.device_idx))
+            self.scratch = torch.empty((self.scratch_bytes,), dtype = torch.uint8, device = _torch_device(self.device_idx))
 
         self.ready = True
 
 
+    def release(self):
+
+        # Drop the scratch arena and constant tensors. They're rebuilt on next use. Refuse while any loaded module on
+        # this device still points into the arena, since it would stay alive and the next forward would allocate a
+        # second one next to it
+
+        for module in self.model.modules:
+            for m in [module] + getattr(module, "submodules", []):
+                if m.device_idx == self.device_idx and m.holds_scratch(): return 0
+
+        released = self.scratch_bytes if self.scratch is not None else 0
+
+        self.scratch = None
+        self.sin = None
+        self.cos = None
+        self.causal_mask = None
+        self.causal_mask_bool = None
+        self.scratch_idx = 0
+        self.ready = False
+
+        return released
+
+
     def begin_scratch_alloc(self):
 
         self.scratch_idx = 0
 
 
-    def get_scratch_slice(self, size_bytes):
+    @contextmanager
+    def scratch_scope(self):
+
+        # Slices allocated inside the scope are released on exit, so nested users can share the tail of the arena
+
+        scratch_idx = self.scratch_idx
+        try:
+            yield self
+        finally:
+            self.scratch_idx = scratch_idx
+
+
+    def get_scratch_slice(self, size_bytes, dtype = torch.half):
 
         if self.scratch is None: self.prepare(True)
 
-        size_bytes = ((size_bytes + 127) // 128) * 128
-        size_half = size_bytes // 2
-        scratch_slice = self.scratch.narrow(0, self.scratch_idx, size_half)
-        self.scratch_idx += size_half
+        assert size_bytes % SCRATCH_ALIGN == 0, "Unaligned scratch allocation"
+        scratch_slice = self.scratch.narrow(0, self.scratch_idx, size_bytes).view(dtype)
+        self.scratch_idx += size_bytes
         return scratch_slice
 
 
@@ -78,31 +150,69 @@ class ExLlamaV2DeviceTensors:
         alpha = self.model.config.scale_alpha_value
         scale = self.model.config.scale_pos_emb
         head_dim = self.model.config.head_dim
+        max_seq_len = self.model.config.max_seq_len
         device = _torch_device(self.device_idx)
 
-        if alpha != 1.0: base *= alpha ** (self.model.config.head_dim / (self.model.config.head_dim - 2))
+        key = (base, alpha, scale, head_dim, max_seq_len)
+        if key in _sincos_cache:
+            sin, cos = _sincos_cache[key]
+            self.sin = sin.to(device, non_blocking = True)
+            self.cos = cos.to(device, non_blocking = True)
+            return
+
+        base = _rope_base(base, alpha, head_dim)
+
+        # Inverse frequencies (with position scaling folded in) are a tiny vector, so compute them on the host and
+        # launch only the outer product on the device
+
+        inv_freq = 1.0 / (base ** (torch.arange(0, head_dim, 2).float() / head_dim))
+        if scale != 1.0: inv_freq /= scale
+
+        t = torch.arange(max_seq_len, device = device, dtype = torch.float32)
+        freqs = torch.outer(t, inv_freq.to(device))
 
-        inv_freq = 1.0 / (base ** (torch.arange(0, head_dim, 2, device = device).float() / head_dim))
-        t = torch.arange(self.model.config.max_seq_len, device = device, dtype = torch.float32)
+        # Both halves of each table are identical, so evaluate sin/cos once on [max_seq_len, head_dim / 2] and write
+        # the result (cast to half) into each half of the output
 
-        if scale != 1.0: t /= scale
+        half_dim = head_dim // 2
+        self.sin = torch.empty((max_seq_len, head_dim), dtype = torch.half, device = device)
+        self.cos = torch.empty((max_seq_len, head_dim), dtype = torch.half, device = device)
 
-        freqs = torch.einsum("i,j->ij", t, inv_freq)
-        emb = torch.cat((freqs, freqs), dim=-1)
+        c = freqs.cos()
+        s = freqs.sin_()
+        self.sin[..., :half_dim].copy_(s)
+        self.sin[..., half_dim:].copy_(s)
+        self.cos[..., :half_dim].copy_(c)
+        self.cos[..., half_dim:].copy_(c)
+
+        _sincos_cache[key] = (self.sin.cpu().pin_memory(), self.cos.cpu().pin_memory())
+
+
+    def prepare_causal_mask(self):
+
+        # Upper triangle for the longest chunk processed in one forward pass. Masks for shorter chunks are views into it
+
+        max_input_len = self.model.config.max_input_len
+        device = _torch_device(self.device_idx)
 
-        self.sin = emb.sin()[None, None, :, :].half()
-        self.cos = emb.cos()[None, None, :, :].half()
+        self.causal_mask_bool = torch.ones((max_input_len, max_input_len), dtype = torch.bool, device = device).triu_(1)
+        self.causal_mask = torch.zeros((max_input_len, max_input_len), dtype = torch.half, device = device)
+        self.causal_mask.masked_fill_(self.causal_mask_bool, _NEG_INF_H)
 
 
 class ExLlamaV2:
 
     config: ExLlamaV2Config
-    modules: list = []
-    modules_dict: dict = {}
-    device_tensors: list = []
+    modules: list
+    modules_dict: dict
+    device_tensors: list
     cache_map: dict
     last_kv_layer_idx: int
 
+    _module_devices: list                       # torch.device for each module, set by set_device_map()
+    _device_runs: list                          # (device, begin, end) for each run of consecutive modules on one device
+    _module_forward: list                       # Bound forward method of each module, indexed like modules
+
 
     def __init__(self, config: ExLlamaV2Config, lazy_load = False):
 
@@ -140,17 +250,17 @@ class ExLlamaV2:
         self.last_kv_layer_idx = layer_idx
 
 
-    def set_device_map(self, allocation, embed_cpu = True):
+    def set_device_map(self, allocation, embed_cpu = True, reserve_cache = False):
 
         self.cache_map = {}
 
         # Constant shared between layers
 
         sincos_size = self.config.head_dim * self.config.max_seq_len * 2
-        constant_size = sincos_size * 2
+        causal_mask_size = self.config.max_input_len ** 2 * (2 + 1)
+        constant_size = sincos_size * 2 + causal_mask_size
 
         # Max size of hidden state
-        # TODO: Option to reserve space for cache while loading model
 
         state_size = self.config.hidden_size * self.config.max_input_len * self.config.max_batch_size * 2
         mask_size = self.config.max_input_len ** 2 * 2
@@ -180,9 +290,11 @@ class ExLlamaV2:
             attn_bytes_current = 0
             if isinstance(module, ExLlamaV2Attention): attn_bytes_current = module.temp_attn_size()
 
-            # Advance current_idx until module fits in allocation
+            # Advance current_idx until module fits in allocation. With reserve_cache, each attention layer also
+            # claims space for its slice of a full-size cache on the same device
 
             footprint = module.weight_footprint()   # Footprint, in bytes
+            if reserve_cache and isinstance(module, ExLlamaV2Attention): footprint += module.cache_footprint()
             scratch = module.scratch_space()        # Scratch space required by module
 
             while True:
@@ -214,23 +326,22 @@ class ExLlamaV2:
         # Create map for cache
 
         self.set_cache_map()
+        self.set_device_runs()
 
         # Return unused space, in GB
 
         return [(ab - rb - rba) / 1024**3 for (ab, rb, rba) in zip(allocation_bytes, reserve_bytes, reserve_bytes_attn)]
 
 
-    def load(self, gpu_split = None, lazy = False, stats = False):
+    def load(self, gpu_split = None, lazy = False, stats = False, reserve_cache = False):
 
         with torch.inference_mode():
 
-            stats = self.set_device_map(gpu_split or [99999])
+            stats = self.set_device_map(gpu_split or [99999], reserve_cache = reserve_cache)
 
             # Load module weights
 
-            if not lazy:
-
-                for module in self.modules: module.load()
+            if not lazy: self.load_modules()
 
             # Cache map
 
@@ -240,12 +351,61 @@ class ExLlamaV2:
             else: return gpu_split
 
 
+    def load_modules(self):
+
+        # Group modules by device and load each group in its own thread, so safetensors reads and host-to-device
+        # copies for one GPU overlap with those for the others
+
+        device_modules = {}
+        for module in self.modules:
+            device_modules.setdefault(module.device_idx, []).append(module)
+
+        if len([idx for idx in device_modules.keys() if idx != -1]) <= 1:
+            for module in self.modules: module.load()
+            return
+
+        with ThreadPoolExecutor(max_workers = len(device_modules)) as executor:
+            futures = [executor.submit(self._load_device_modules, idx, modules) for idx, modules in device_modules.items()]
+            for f in futures: f.result()
+
+        for idx in device_modules.keys():
+            if idx != -1: torch.cuda.synchronize(idx)
+
+
+    def _load_device_modules(self, device_idx, modules):
+
+        # Inference mode and the current CUDA device are thread-local. Modules load on the device's default stream
+        # since the extension launches its kernels there
+
+        with torch.inference_mode():
+
+            if device_idx == -1:
+                for module in modules: module.load()
+
+            else:
+                with torch.cuda.device(device_idx):
+                    for module in modules: module.load()
+
+
     def set_cache_map(self):
 
         for module in self.modules:
             if isinstance(module, ExLlamaV2Attention): self.cache_map[module.layer_idx] = module.device()
 
 
+    def set_device_runs(self):
+
+        self._module_devices = [torch.device(_torch_device(module.device_idx)) for module in self.modules]
+        self._module_forward = [module.forward for module in self.modules]
+        self._device_runs = []
+
+        for idx, device in enumerate(self._module_devices):
+            if self._device_runs and self._device_runs[-1][0] == device:
+                self._device_runs[-1] = (device, self._device_runs[-1][1], idx + 1)
+            else:
+                self._device_runs.append((device, idx, idx + 1))
+
+
     def create_device_tensors(self, scratch_bytes):
 
         for idx, bytes in enumerate(scratch_bytes):
@@ -261,11 +421,46 @@ class ExLlamaV2:
         return tensors
 
 
+    def release_scratch_all(self):
+
+        # Returns the number of scratch bytes actually dropped. Devices with loaded modules are left as they are
+
+        return sum(tensors.release() for tensors in self.device_tensors)
+
+
     def get_modules(self):
 
         return [module for module in self.modules]
 
 
+    def get_causal_mask(self, seq_len, device, dtype = torch.half):
+
+        # Half mask to add to attention weights, or bool mask (True above the diagonal) to fill other masks with
+
+        device = torch.device(device)
+
+        if device.type == "cuda" and device.index < len(self.device_tensors):
+            tensors = self.get_device_tensors(device.index, scratch = False)
+            causal_mask = tensors.causal_mask_bool if dtype == torch.bool else tensors.causal_mask
+            if seq_len <= causal_mask.shape[0]: return causal_mask[:seq_len, :seq_len]
+
+        causal_mask = torch.ones((seq_len, seq_len), dtype = torch.bool, device = device).triu_(1)
+        if dtype == torch.bool: return causal_mask
+        return torch.zeros((seq_len, seq_len), dtype = torch.half, device = device).masked_fill_(causal_mask, _NEG_INF_H)
+
+
+    def prepare_input_mask(self, input_mask):
+
+        # Convert a [batch_size, seq_len] padding mask (or list of them, for multiple caches) to the float16
+        # [batch_size, 1, 1, seq_len] form build_attn_mask consumes, on the first GPU. Callers forwarding the same
+        # sequence in several chunks can do this once and pass the result as input_mask
+
+        if isinstance(input_mask, list): return [self.prepare_input_mask(m) for m in input_mask]
+
+        device = next((d for d, _, _ in self._device_runs if d.type != "cpu"), "cpu")
+        return input_mask.to(device, torch.half).unsqueeze(1).unsqueeze(2)
+
+
     def build_attn_mask(self, batch_size, seq_len, past_len, input_mask, device):
 
         if input_mask is None and seq_len == 1: return None
@@ -273,17 +468,17 @@ class ExLlamaV2:
         if isinstance(past_len, tuple):
 
             attn_masks = []
+            causal_mask = self.get_causal_mask(seq_len, device, torch.bool)
 
             for i in range(len(past_len[1])):
 
-                attn_mask = torch.zeros(1, 1, seq_len, past_len[1][i] + seq_len, dtype = torch.float16, device = device)
-                attn_mask_triu = torch.triu(torch.full((seq_len - 1, seq_len - 1), -65504.))
-                attn_mask[:, :, : seq_len - 1, past_len[1][i] + 1: past_len[1][i] + seq_len] = attn_mask_triu
+                attn_mask = torch.zeros(seq_len, past_len[1][i] + seq_len, dtype = torch.float16, device = device)
+                attn_mask.narrow(1, past_len[1][i], seq_len).masked_fill_(causal_mask, _NEG_INF_H)
+                attn_mask = attn_mask.unsqueeze(0).unsqueeze(0)
 
                 if input_mask is not None:
                     min_mask_width = min(input_mask[i].shape[-1], seq_len + past_len[1][i])
-                    input_mask_part = input_mask[i][:, :min_mask_width].to(attn_mask.device)
-                    input_mask_part = input_mask_part.unsqueeze(1).unsqueeze(2)
+                    input_mask_part = _input_mask_part(input_mask[i], min_mask_width, attn_mask.device)
                     attn_mask[:, :, :, :min_mask_width] = torch.minimum(attn_mask[:, :, :, :min_mask_width], input_mask_part)
 
                 attn_masks.append(attn_mask)
@@ -292,25 +487,47 @@ class ExLlamaV2:
 
         else:
 
-            attn_mask = torch.zeros(batch_size, 1, seq_len, past_len + seq_len, dtype = torch.float16, device = device)
-            attn_mask_triu = torch.triu(torch.full((seq_len - 1, seq_len - 1), -65504.))
-            attn_mask[:, :, : seq_len - 1, past_len + 1: past_len + seq_len] = attn_mask_triu
+            # Without padding or past keys the mask is the same for every batch row and can be broadcast from the
+            # cached triangle
+
+            if past_len == 0 and input_mask is None:
+                return self.get_causal_mask(seq_len, device).unsqueeze(0).unsqueeze(0)
+
+            # Build a single [seq_len, past_len + seq_len] mask and broadcast it over the batch. Only a padding mask
+            # needs separate rows per sequence
+
+            attn_mask = torch.zeros(seq_len, past_len + seq_len, dtype = torch.float16, device = device)
+            causal_mask = self.get_causal_mask(seq_len, device, torch.bool)
+            attn_mask.narrow(1, past_len, seq_len).masked_fill_(causal_mask, _NEG_INF_H)
 
-            if input_mask is not None:
-                min_mask_width = min(input_mask.shape[-1], seq_len + past_len)
-                input_mask_part = input_mask[:, :min_mask_width].to(attn_mask.device)
-                input_mask_part = input_mask_part.unsqueeze(1).unsqueeze(2)
-                attn_mask[:, :, :, :min_mask_width] = torch.minimum(attn_mask[:, :, :, :min_mask_width], input_mask_part)
+            if input_mask is None:
+                return attn_mask.expand(batch_size, 1, -1, -1)
+
+            attn_mask = attn_mask.repeat(batch_size, 1, 1, 1)
+            min_mask_width = min(input_mask.shape[-1], seq_len + past_len)
+            input_mask_part = _input_mask_part(input_mask, min_mask_width, attn_mask.device)
+            attn_mask[:, :, :, :min_mask_width] = torch.minimum(attn_mask[:, :, :, :min_mask_width], input_mask_part)
 
             return attn_mask
 
 
+    # Capturing the module loop in a CUDA graph isn't possible as long as attention shapes and the extension's kernel
+    # arguments depend on past_len, so instead keep autograd out of the per-token path
+
+    @torch.inference_mode()
     def forward(self, input_ids, cache = None, input_mask = None, preprocess_only = False):
 
         q_len = input_ids.shape[-1]
         remaining_q_len = q_len
         bsz = input_ids.shape[0]
 
+        # Single-token step with one cache and no padding needs no chunking and no attention mask
+
+        if q_len == 1 and input_mask is None and not preprocess_only and isinstance(cache, ExLlamaV2Cache):
+
+            assert cache.current_seq_len + 1 <= cache.max_seq_len, "Total sequence length exceeds cache size in model.forward"
+            return self.forward_decode(input_ids, cache)
+
         # Attn and MLP layers have preallocated buffers for temp states, sized by the model config. Effective max input
         # length depends on the current batch size
 
@@ -374,6 +591,23 @@ class ExLlamaV2:
         return result
 
 
+    @torch.inference_mode()
+    def forward_decode(self, input_ids, cache):
+
+        past_len = cache.current_seq_len
+        module_forward = self._module_forward
+        x = input_ids
+
+        for device, begin, end in self._device_runs:
+
+            x = x.to(device, non_blocking = device.type != "cpu")
+            for idx in range(begin, end):
+                x = module_forward[idx](x, cache = cache, past_len = past_len)
+
+        cache.current_seq_len += 1
+        return x
+
+
     def _forward(self, input_ids, cache = None, input_mask = None, preprocess_only = False):
 
         batch_size, seq_len = input_ids.shape
@@ -388,33 +622,47 @@ class ExLlamaV2:
 
         # assert cache is None or isinstance(cache, list) or batch_size <= cache.batch_size
 
+        # The mask is the same on every device. Unless it's just a view of the cached causal triangle, build it on the
+        # first device and copy it to the rest
+
+        copy_mask = input_mask is not None or isinstance(past_len, tuple) or past_len > 0
+
+        module_forward = self._module_forward
         x = input_ids
-        prev_device = None
         attn_mask = None
+        mask_built = False
 
-        for idx, module in enumerate(self.modules):
+        for device, begin, end in self._device_runs:
 
-            device = _torch_device(module.device_idx)
+            if preprocess_only and begin > self.last_kv_layer_idx: break
 
             # Build attention mask
 
-            if device != prev_device and device != "cpu":
+            if device.type != "cpu":
+
+                if copy_mask and mask_built:
+                    attn_mask = _move_attn_mask(attn_mask, device)
+                else:
+                    attn_mask = self.build_attn_mask(batch_size, seq_len, past_len, input_mask, device)
+                    mask_built = True
 
-                prev_device = device
-                attn_mask = self.build_attn_mask(batch_size, seq_len, past_len, input_mask, device)
                 if isinstance(past_len, tuple): past_len = (past_len[0].to(device), past_len[1])
 
-            # Onward
+            # Onward. Copies to a GPU needn't block the host (the CPU embedding output is pinned), but a copy to the
+            # CPU must complete before the CPU embedding reads it
 
-            x = x.to(device)
-            x = module.forward(x, cache = cache, attn_mask = attn_mask, past_len = past_len)
+            x = x.to(device, non_blocking = device.type != "cpu")
 
-            if preprocess_only and idx == self.last_kv_layer_idx:
-                x = None
-                break
+            for idx in range(begin, end):
+
+                x = module_forward[idx](x, cache = cache, attn_mask = attn_mask, past_len = past_len)
+
+                if preprocess_only and idx == self.last_kv_layer_idx: break
+
+                # print(self.modules[idx].key, self.modules[idx].name, x[0, 0])
+                # print("max", torch.max(x).item(), "min",torch.min(x).item())
 
-            # print(module.key, module.name, x[0, 0])
-            # print("max", torch.max(x).item(), "min",torch.min(x).item())
+        if preprocess_only: x = None
 
         # Advance cache
 
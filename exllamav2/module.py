@@ -9,6 +9,14 @@ def _torch_device(idx):
     return f"cuda:{idx}"
 
 
+# Scratch slices are handed out at this alignment, so modules must round their scratch sizes up to it
+
+SCRATCH_ALIGN = 256
+
+def _scratch_align(size_bytes):
+    return (size_bytes + SCRATCH_ALIGN - 1) // SCRATCH_ALIGN * SCRATCH_ALIGN
+
+
 def _tsize(st, key):
 
     tslice = st.get_slice(key)
@@ -123,3 +131,11 @@ class ExLlamaV2Module:
     def set_device_idx(self, idx):
 
         self.device_idx = idx
+
+
+    def holds_scratch(self):
+
+        # True while the module (or the extension, through its handle) references slices of the device scratch arena.
+        # Modules that take scratch slices override this
+
+        return False